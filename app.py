@@ -1,11 +1,60 @@
 import streamlit as st
-import urllib.request
+import urllib3
 import tarfile
+import gzip
 import subprocess
 import os
 import shutil
 import tempfile
 import re
+import io
+import json
+import hashlib
+import zipfile
+import time
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Persistent per-user cache, shared across Streamlit sessions and restarts
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "vibearxivdiff")
+# Published arXiv versions are immutable, so cached e-prints can be kept for a long time
+EPRINT_CACHE_DAYS = 30
+# Size cap of each cache folder; the least recently used entries (oldest mtime) are deleted beyond it
+CACHE_MAX_BYTES = {"eprints": 2 << 30, "difftex": 256 << 20, "pdfs": 2 << 30}
+# Usual names of the main .tex file, checked before scanning the whole source tree
+MAIN_TEX_CANDIDATES = ("main.tex", "ms.tex", "paper.tex", "article.tex", "manuscript.tex")
+# Folders not worth searching for the main .tex file
+SKIP_DIRS = {"__MACOSX", ".git", "figures", "figs", "images"}
+# Build by-products left out of the source zip offered when compilation fails
+BUILD_ARTIFACTS = (
+    ".aux", ".log", ".fls", ".fdb_latexmk", ".fmt", ".out", ".toc", ".synctex.gz", ".bcf", ".run.xml"
+)
+# pdflatex message after which no number of latexmk reruns can produce a PDF. In nonstopmode, a missing
+# .sty, .cls or \input file ends in it, while recoverable errors (e.g., a missing figure) do not.
+FATAL_TEX_ERROR = "Emergency stop"
+# Substrings of the .tex sources that call for extra passes (bibliography, cross-references, contents, index, ...).
+# They err on the side of matching (e.g., "cite" also catches \parencite and \textcite): a false positive only costs the full latexmk run.
+MULTIPASS_MARKERS = (
+    b"cite", b"ref{", b"ref*{", b"\\bibliography", b"\\addbibresource", b"\\printbibliography",
+    b"\\tableofcontents", b"\\listof", b"\\printindex", b"\\makeglossaries", b"\\printglossar", b"remember picture"
+)
+# pdflatex messages asking for another pass, or reporting unresolved citations and references,
+# that the static scan above did not foresee
+RERUN_MARKERS = ("Rerun", "Label(s) may have changed", "Table widths have changed", "There were undefined")
+# Number of compiler output lines kept for the error log shown to the user
+LOG_TAIL_LINES = 2000
+# Experimental: dump the preamble of diff.tex into a format file once, so that the repeated pdflatex
+# passes of latexmk don't each reload every package. Off by default, as not all packages survive a dump.
+PRECOMPILE_PREAMBLE = os.environ.get("VIBEARXIVDIFF_PRECOMPILE_PREAMBLE") == "1"
+# Keep TeX's generated fonts and caches in a stable place so they survive across runs
+TEX_ENV = {
+    **os.environ,
+    "TEXMFVAR": os.path.join(CACHE_DIR, "texmf-var"),
+    "TEXMFCACHE": os.path.join(CACHE_DIR, "texmf-cache"),
+}
+for _tex_dir in (TEX_ENV["TEXMFVAR"], TEX_ENV["TEXMFCACHE"]):
+    os.makedirs(_tex_dir, exist_ok=True)
 
 def parse_arxiv_id(input_str):
     """Extracts the base arXiv ID from a full URL or dirty string."""
@@ -22,42 +71,414 @@ def parse_arxiv_id(input_str):
     # If no pattern matches, return the stripped input as a fallback
     return input_str.strip()
 
-def download_and_extract(arxiv_id, version, extract_to):
+@st.cache_resource(show_spinner=False)
+def _http_pool():
+    """Returns the process-wide connection pool, so TLS connections to arxiv.org are reused across downloads and reruns."""
+    return urllib3.PoolManager(
+        maxsize=2, # The two versions are downloaded in parallel
+        # Custom User-Agent to comply with arXiv's automated download policies
+        headers={'User-Agent': 'VibeArxivDiff-App'},
+        timeout=urllib3.Timeout(connect=10, read=60)
+    )
+
+_HTTP = _http_pool()
+
+@st.cache_resource(show_spinner=False)
+def _latexdiff_version():
+    """Returns the version banner of the installed latexdiff, so that upgrading it invalidates cached diffs."""
+    try:
+        result = subprocess.run(["latexdiff", "--version"], capture_output=True, text=True, errors="replace")
+    except OSError:
+        return "unknown"
+    return (result.stdout + result.stderr).strip()
+
+LATEXDIFF_VERSION = _latexdiff_version()
+
+def _safe_name(s):
+    """Makes a user-supplied string (e.g., an old-style ID like hep-th/9901001) safe to use as a file name."""
+    return re.sub(r"[^\w.-]", "_", s)
+
+def _prune_cache(name):
+    """Deletes the oldest files of the cache folder name until it fits in CACHE_MAX_BYTES[name]."""
+    entries = []
+    try:
+        with os.scandir(os.path.join(CACHE_DIR, name)) as it:
+            for entry in it:
+                # Leave in-progress downloads and copies alone
+                if entry.is_file() and not entry.name.endswith(".part"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES[name]:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def _fetch_eprint(arxiv_id, version):
+    """Returns the path to a cached copy of the e-print, downloading it only if missing or stale."""
+    cache_dir = os.path.join(CACHE_DIR, "eprints")
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_name = f"{_safe_name(arxiv_id)}v{_safe_name(version)}"
+    cached_path = os.path.join(cache_dir, f"{cache_name}.tar.gz")
+    # Sidecar holding the HTTP validators (ETag, Last-Modified) of the cached copy
+    meta_path = os.path.join(cache_dir, f"{cache_name}.meta.json")
+    if os.path.exists(cached_path) and time.time() - os.path.getmtime(cached_path) < EPRINT_CACHE_DAYS * 86400:
+        return cached_path
+
     url = f"https://arxiv.org/e-print/{arxiv_id}v{version}"
-    archive_path = os.path.join(extract_to, f"v{version}.tar.gz")
-    
-    # Custom User-Agent to comply with arXiv's automated download policies
-    req = urllib.request.Request(url, headers={'User-Agent': 'VibeArxivDiff-App'})
-    with urllib.request.urlopen(req) as response, open(archive_path, 'wb') as out_file:
-        out_file.write(response.read())
+    # Per-request headers replace the pool's entirely, so start from them to keep the User-Agent
+    headers = dict(_HTTP.headers)
+    if os.path.exists(cached_path):
+        # Revalidate the stale copy: if it hasn't changed, arXiv answers 304 without resending the archive
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        if meta.get("etag"):
+            headers['If-None-Match'] = meta["etag"]
+        if meta.get("last_modified"):
+            headers['If-Modified-Since'] = meta["last_modified"]
+
+    # decode_content=False keeps the archive bytes exactly as arXiv serves them
+    response = _HTTP.request("GET", url, headers=headers, preload_content=False, decode_content=False)
+    try:
+        if response.status == 304:
+            # Not modified: the cached copy is good for another EPRINT_CACHE_DAYS
+            os.utime(cached_path)
+            return cached_path
+        if response.status == 404:
+            raise FileNotFoundError(f"arXiv has no e-print for {arxiv_id}v{version}.")
+        if response.status >= 400:
+            raise RuntimeError(f"arXiv returned HTTP {response.status} for {url}.")
+
+        # Download to a temporary file and rename it, so a concurrent run never sees a partial archive
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                # Stream in 1 MiB chunks rather than holding the whole archive in memory
+                shutil.copyfileobj(response, out_file, length=1024 * 1024)
+            # Never cache an error or captcha page served with a 200 status: it would pass for a flat .tex file
+            with open(tmp_path, 'rb') as f:
+                if f.read(512).lstrip().lower().startswith((b"<!doctype html", b"<html")):
+                    raise RuntimeError(f"arXiv returned a web page instead of the e-print for {arxiv_id}v{version}. Please try again later.")
+            os.replace(tmp_path, cached_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        meta = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    finally:
+        # Hand the connection back to the pool for the next download. Any unread body (error pages, ...)
+        # must be drained first, or the connection gets dropped instead of kept alive.
+        response.drain_conn()
+        response.release_conn()
+
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return cached_path
+
+def download_and_extract(arxiv_id, version, extract_to):
+    # Read straight from the cache; no need to copy the archive into the temp folder first
+    archive_path = _fetch_eprint(arxiv_id, version)
 
     version_dir = os.path.join(extract_to, f"v{version}")
     os.makedirs(version_dir, exist_ok=True)
-    
-    try:
+
+    # Sniff the format from the first bytes rather than attempting a tar parse that may fail
+    with open(archive_path, 'rb') as f:
+        head = f.read(512)
+    if head.startswith(b"%PDF"):
+        # arXiv serves the PDF when no LaTeX source is available
+        raise FileNotFoundError(f"arXiv only provides a PDF for {arxiv_id}v{version}; the LaTeX source is not available.")
+    gzipped = head.startswith(b"\x1f\x8b")
+    if gzipped:
+        with gzip.open(archive_path, 'rb') as f:
+            head = f.read(512)
+
+    # POSIX tar headers carry the "ustar" magic at offset 257. Pre-POSIX (v7) tarballs lack it, so let tarfile decide for those.
+    if head[257:262] == b"ustar" or tarfile.is_tarfile(archive_path):
         with tarfile.open(archive_path) as tar:
-            tar.extractall(path=version_dir)
-    except tarfile.ReadError:
-        # Fallback if arXiv serves a single flat .tex file instead of an archive
-        shutil.move(archive_path, os.path.join(version_dir, "main.tex"))
+            # The "data" filter rejects absolute paths, links outside the folder, device files, etc.
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(path=version_dir, filter="data")
+            else:
+                tar.extractall(path=version_dir)
+    elif gzipped:
+        # arXiv serves a single-file submission as a gzipped .tex file
+        with gzip.open(archive_path, 'rb') as src, open(os.path.join(version_dir, "main.tex"), 'wb') as dst:
+            shutil.copyfileobj(src, dst)
     else:
-        os.remove(archive_path)
+        # Fallback if arXiv serves a single flat .tex file instead of an archive
+        shutil.copyfile(archive_path, os.path.join(version_dir, "main.tex"))
         
     return version_dir
 
+def _has_begin_document(path, limit=65536):
+    try:
+        # Search raw bytes to skip decoding. By default only the head is read, as \begin{document} usually sits
+        # near the top and huge generated files needn't be loaded in full; limit=-1 reads the whole file.
+        with open(path, 'rb') as f:
+            return b"\\begin{document}" in f.read(limit)
+    except OSError:
+        return False
+
+def _iter_tex_files(directory, skip_dirs=SKIP_DIRS):
+    """Yields the paths of all .tex files under directory, top-down. By default, skips folders that never hold the main file."""
+    stack = [directory]
+    while stack:
+        subdirs = []
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in skip_dirs:
+                        subdirs.append(entry.path)
+                elif entry.name.endswith(".tex") and entry.is_file():
+                    yield entry.path
+        # Reversed so that subfolders are visited in listing order
+        stack.extend(reversed(subdirs))
+
 def find_main_tex(directory):
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".tex"):
-                path = os.path.join(root, file)
-                try:
-                    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-                        if r"\begin{document}" in f.read():
-                            return path
-                except Exception:
-                    continue
+    # Most submissions use one of the usual names at the top level, which saves scanning every file.
+    # There are only a few, so read them in full: a long preamble must not let another file win.
+    for name in MAIN_TEX_CANDIDATES:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and _has_begin_document(path, -1):
+            return path
+
+    paths = list(_iter_tex_files(directory))
+    # Head-only pass first. Then, for preambles longer than the head, read the files in full.
+    for limit in (65536, -1):
+        # Reading the files is I/O-bound, so do it in parallel, but keep the first match in walk order
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(_has_begin_document, path, limit) for path in paths]
+            for path, future in zip(paths, futures):
+                if future.result():
+                    # Don't bother reading the files still queued
+                    for pending in futures:
+                        pending.cancel()
+                    return path
     raise FileNotFoundError(f"Could not find a .tex file with \\begin{{document}} in {directory}")
 
+def _copy_to_cache(path, cached_path):
+    # Copy then rename, so a concurrent run never reads a partial file
+    cache_dir = os.path.dirname(cached_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".part")
+    os.close(fd)
+    try:
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, cached_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def _run_latexdiff(tex_v1, tex_v2, diff_tex_path):
+    """Writes the latexdiff of tex_v1 and tex_v2 to diff_tex_path, reusing a cached result when the inputs are unchanged."""
+    options = ["--math-markup=0"]
+    # Without --flatten, latexdiff only reads the two main files, so they, the options and the latexdiff
+    # version fully determine its output
+    digest = hashlib.blake2b(repr((options, LATEXDIFF_VERSION)).encode())
+    for path in (tex_v1, tex_v2):
+        with open(path, 'rb') as f:
+            # Fixed-size digest per file, so no two different pairs of files map to the same key
+            digest.update(hashlib.blake2b(f.read()).digest())
+    cache_dir = os.path.join(CACHE_DIR, "difftex")
+    cached_path = os.path.join(cache_dir, f"{digest.hexdigest()}.tex")
+    if os.path.exists(cached_path):
+        shutil.copyfile(cached_path, diff_tex_path)
+        # Mark as recently used, so pruning deletes it last
+        os.utime(cached_path)
+        return
+
+    # FIX 1: Open in binary mode ("wb") so we don't force UTF-8 decoding
+    with open(diff_tex_path, "wb") as f:
+        subprocess.run(
+            ["latexdiff", *options, os.path.abspath(tex_v1), os.path.abspath(tex_v2)], 
+            stdout=f, 
+            cwd=os.path.dirname(diff_tex_path),
+            env=TEX_ENV,
+            check=True
+        )
+
+    _copy_to_cache(diff_tex_path, cached_path)
+
+def _zip_sources(directory):
+    """Zips directory in memory, without build by-products, and returns the archive as bytes."""
+    buffer = io.BytesIO()
+    # Fast, light compression: the sources are mostly text, and speed matters more than size here
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        for root, dirs, files in os.walk(directory):
+            # Skip hidden folders (.git, ...) and macOS resource forks
+            dirs[:] = [d for d in dirs if not d.startswith(".") and d != "__MACOSX"]
+            for file in files:
+                if file.endswith(BUILD_ARTIFACTS):
+                    continue
+                path = os.path.join(root, file)
+                archive.write(path, os.path.relpath(path, directory))
+    return buffer.getvalue()
+
+def _find_fatal_tex_error(directory):
+    """Runs a single draft pass of pdflatex on diff.tex. Returns (error line, log) if it hit a fatal error, else None."""
+    try:
+        returncode, log = _run_with_log_tail(
+            ["pdflatex", "-draftmode", "-interaction=nonstopmode", "diff.tex"], directory, timeout=30
+        )
+    except subprocess.TimeoutExpired:
+        # Inconclusive: leave it to latexmk
+        return None
+    if returncode == 0:
+        return None
+    if FATAL_TEX_ERROR not in log:
+        return None
+    # Report the error that caused the stop (e.g., "! LaTeX Error: File `foo.sty' not found.") rather than the stop itself
+    reason = None
+    for line in log.splitlines():
+        if FATAL_TEX_ERROR in line:
+            break
+        if line.startswith("!"):
+            reason = line
+    return reason or FATAL_TEX_ERROR, log
+
+def _needs_multiple_passes(directory):
+    """Tells whether the .tex files under directory (diff.tex and the files it inputs) need more than one pdflatex pass."""
+    # Don't skip figures/ and the like: tables and TikZ code inputted from there can cite and reference too
+    for path in _iter_tex_files(directory, skip_dirs=()):
+        with open(path, 'rb') as f:
+            content = f.read()
+        if any(marker in content for marker in MULTIPASS_MARKERS):
+            return True
+    return False
+
+def _run_with_log_tail(command, cwd, timeout=None):
+    """Runs a TeX command and returns its exit code and only the last LOG_TAIL_LINES lines of its output, which is
+    where the errors are. Raises subprocess.TimeoutExpired if it runs for more than timeout seconds."""
+    with subprocess.Popen(
+        command,
+        cwd=cwd,
+        env=TEX_ENV,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace" # FIX 2: Replaces weird log characters instead of crashing
+    ) as process:
+        # Reading blocks until the output ends, so enforce the timeout by killing the process from a timer
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            process.kill()
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            # Bounded memory however verbose the compilation gets
+            tail = collections.deque(process.stdout, maxlen=LOG_TAIL_LINES)
+        finally:
+            if timer:
+                timer.cancel()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(command, timeout)
+    return process.returncode, "".join(tail)
+
+def _precompile_preamble(directory):
+    """Dumps the preamble of diff.tex into preamble.fmt with mylatexformat. Returns whether it worked."""
+    try:
+        subprocess.run(
+            ["pdflatex", "-ini", "-interaction=nonstopmode", "-jobname=preamble", "&pdflatex", "mylatexformat.ltx", "diff.tex"],
+            cwd=directory,
+            env=TEX_ENV,
+            capture_output=True,
+            timeout=60
+        )
+    except subprocess.TimeoutExpired:
+        return False
+    return os.path.exists(os.path.join(directory, "preamble.fmt"))
+
+class CompilationError(Exception):
+    """Raised when no PDF can be produced. Carries the log and the sources so the user can compile locally."""
+    def __init__(self, log, source_zip, reason=None):
+        super().__init__(reason or "latexmk did not produce a PDF.")
+        self.log = log
+        self.source_zip = source_zip
+        self.reason = reason
+
+def _cached_pdf_path(arxiv_id, v1, v2):
+    # Published arXiv versions never change, so the IDs alone identify the diff
+    return os.path.join(CACHE_DIR, "pdfs", f"{_safe_name(arxiv_id)}_v{_safe_name(v1)}_v{_safe_name(v2)}.pdf")
+
+# Only successful builds end up in the cache: failures raise, and Streamlit does not cache exceptions.
+# The function must not call st.* itself, as cached elements cannot be replayed into the status container.
+# cache_resource rather than cache_data: the PDF bytes are immutable, so every hit can share one object
+# instead of unpickling a fresh copy of a possibly large PDF.
+@st.cache_resource(show_spinner=False, ttl=7 * 86400, max_entries=128)
+def build_diff_pdf(arxiv_id, v1, v2):
+    """Downloads both versions, runs latexdiff and latexmk, and returns the diff PDF as bytes."""
+    # On disk, results survive restarts and are shared by all the app's processes
+    cached_pdf = _cached_pdf_path(arxiv_id, v1, v2)
+    if os.path.exists(cached_pdf):
+        # Mark as recently used, so pruning deletes it last
+        os.utime(cached_pdf)
+        with open(cached_pdf, "rb") as pdf_file:
+            return pdf_file.read()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Both downloads are I/O-bound and extract into distinct v{version} folders, so overlap them
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            future_v1 = executor.submit(download_and_extract, arxiv_id, v1, temp_dir)
+            future_v2 = executor.submit(download_and_extract, arxiv_id, v2, temp_dir)
+            dir_v1, dir_v2 = future_v1.result(), future_v2.result()
+
+        # Both e-prints are extracted by now, so pruning cannot delete one from under us.
+        # Cached e-prints are not marked on use: their mtime tells when they were last validated.
+        for name in CACHE_MAX_BYTES:
+            _prune_cache(name)
+
+        tex_v1 = find_main_tex(dir_v1)
+        tex_v2 = find_main_tex(dir_v2)
+
+        diff_tex_path = os.path.join(dir_v2, "diff.tex")
+        _run_latexdiff(tex_v1, tex_v2, diff_tex_path)
+
+        # A missing package or file stops pdflatex right away, but latexmk -f keeps retrying for a while
+        fatal_error = _find_fatal_tex_error(dir_v2)
+        if fatal_error:
+            reason, log = fatal_error
+            raise CompilationError(log, _zip_sources(dir_v2), reason)
+
+        # No SyncTeX: nobody edits the diff, so writing it is wasted work
+        compile_log = None
+        if not _needs_multiple_passes(dir_v2):
+            # Nothing to resolve on later passes, so a single pdflatex run is usually enough
+            _, compile_log = _run_with_log_tail(
+                ["pdflatex", "-interaction=nonstopmode", "-synctex=0", "-file-line-error", "diff.tex"], dir_v2
+            )
+            # ... unless pdflatex asks for more (longtable widths, hyperref bookmarks, ...). TeX wraps its
+            # output lines, so search across line breaks.
+            if any(marker in compile_log.replace("\n", "") for marker in RERUN_MARKERS):
+                compile_log = None
+
+        if compile_log is None:
+            latexmk_command = ["latexmk", "-pdf", "-f", "-interaction=nonstopmode", "-synctex=0", "-file-line-error"]
+            if PRECOMPILE_PREAMBLE and _precompile_preamble(dir_v2):
+                latexmk_command.append("-pdflatex=pdflatex -fmt=preamble %O %S")
+            _, compile_log = _run_with_log_tail(latexmk_command + ["diff.tex"], dir_v2)
+
+        final_pdf = os.path.join(dir_v2, "diff.pdf")
+
+        if not os.path.exists(final_pdf):
+            # Escape Hatch: Zip the folder so the user can compile locally
+            raise CompilationError(compile_log, _zip_sources(dir_v2))
+
+        _copy_to_cache(final_pdf, cached_pdf)
+
+        with open(final_pdf, "rb") as pdf_file:
+            return pdf_file.read()
+
 # --- Streamlit UI Setup ---
 st.set_page_config(page_title="VibeArxivDiff", page_icon="📄")
 st.title("VibeArxivDiff")
@@ -70,6 +491,7 @@ with col1:
     v1 = st.text_input("Old Version", value="1")
 with col2:
     v2 = st.text_input("New Version", value="2")
+force_rebuild = st.checkbox("Force rebuild", help="Ignore any previously generated PDF for these versions.")
 
 if st.button("Generate Diff PDF"):
     if not arxiv_id or not v1 or not v2:
@@ -77,71 +499,43 @@ if st.button("Generate Diff PDF"):
     else:
         # Clean the input to extract just the ID
         clean_arxiv_id = parse_arxiv_id(arxiv_id)
+        if force_rebuild:
+            try:
+                os.remove(_cached_pdf_path(clean_arxiv_id, v1, v2))
+            except FileNotFoundError:
+                pass
+            # Drop only this diff from memory; other users' cached diffs are untouched
+            build_diff_pdf.clear(clean_arxiv_id, v1, v2)
         
         with st.status(f"Processing paper {clean_arxiv_id}... this usually takes 1-2 minutes.", expanded=True) as status:
             try:
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    st.write(f"Downloading v{v1} and v{v2}...")
-                    
-                    # IMPORTANT: Use clean_arxiv_id here instead of the raw arxiv_id
-                    dir_v1 = download_and_extract(clean_arxiv_id, v1, temp_dir)
-                    dir_v2 = download_and_extract(clean_arxiv_id, v2, temp_dir)
-                    
-                    st.write("Locating main .tex files...")
-                    tex_v1 = find_main_tex(dir_v1)
-                    tex_v2 = find_main_tex(dir_v2)
-                    
-                    st.write("Running latexdiff...")
-                    diff_tex_path = os.path.join(dir_v2, "diff.tex")
+                # IMPORTANT: Use clean_arxiv_id here instead of the raw arxiv_id
+                pdf_bytes = build_diff_pdf(clean_arxiv_id, v1, v2)
                     
-                    # FIX 1: Open in binary mode ("wb") so we don't force UTF-8 decoding
-                    with open(diff_tex_path, "wb") as f:
-                        subprocess.run(
-                            ["latexdiff", "--math-markup=0", os.path.abspath(tex_v1), os.path.abspath(tex_v2)], 
-                            stdout=f, 
-                            cwd=dir_v2,
-                            check=True
-                        )
+                status.update(label="Compilation successful!", state="complete", expanded=False)
+                st.download_button(
+                    label="Download Diff PDF",
+                    data=pdf_bytes,
+                    file_name=f"{arxiv_id}_v{v1}_to_v{v2}_diff.pdf",
+                    mime="application/pdf"
+                )
+            except CompilationError as e:
+                status.update(label="Compilation failed.", state="error", expanded=False)
+                st.error("The cloud server is missing a package required by this paper, or latexdiff created unresolvable syntax.")
+                if e.reason:
+                    st.code(e.reason, language="text")
+                
+                # Escape Hatch: Offer the sources for download
+                st.download_button(
+                    label="Download Source Files (.zip) to Compile Locally",
+                    data=e.source_zip,
+                    file_name=f"{arxiv_id}_v{v1}_to_v{v2}_source.zip",
+                    mime="application/zip"
+                )
                     
-                    st.write("Compiling PDF...")
-                    compile_process = subprocess.run(
-                        ["latexmk", "-pdf", "-f", "-interaction=nonstopmode", "diff.tex"], 
-                        cwd=dir_v2,
-                        capture_output=True, 
-                        text=True,
-                        errors="replace" # FIX 2: Replaces weird log characters instead of crashing
-                    )
-                    
-                    final_pdf = os.path.join(dir_v2, "diff.pdf")
-                    
-                    if os.path.exists(final_pdf):
-                        with open(final_pdf, "rb") as pdf_file:
-                            pdf_bytes = pdf_file.read()
-                            
-                        status.update(label="Compilation successful!", state="complete", expanded=False)
-                        st.download_button(
-                            label="Download Diff PDF",
-                            data=pdf_bytes,
-                            file_name=f"{arxiv_id}_v{v1}_to_v{v2}_diff.pdf",
-                            mime="application/pdf"
-                        )
-                    else:
-                        status.update(label="Compilation failed.", state="error", expanded=False)
-                        st.error("The cloud server is missing a package required by this paper, or latexdiff created unresolvable syntax.")
-                        
-                        # Escape Hatch: Zip the folder and offer it for download
-                        zip_path = shutil.make_archive(dir_v2, 'zip', dir_v2)
-                        with open(zip_path, "rb") as zip_file:
-                            st.download_button(
-                                label="Download Source Files (.zip) to Compile Locally",
-                                data=zip_file.read(),
-                                file_name=f"{arxiv_id}_v{v1}_to_v{v2}_source.zip",
-                                mime="application/zip"
-                            )
-                            
-                        # Surface the error log for debugging
-                        with st.expander("View latexmk error log"):
-                            st.code(compile_process.stdout, language="text")
+                # Surface the error log for debugging
+                with st.expander("View latexmk error log"):
+                    st.code(e.log, language="text")
                             
             except FileNotFoundError as e:
                 status.update(label="Error locating files.", state="error")